@@ -12,7 +12,7 @@ if [ ! -f "$VERSION_FILE" ]; then
 fi
 
 # Read current version
-current_version=$(cat "$VERSION_FILE")
+current_version=$(<"$VERSION_FILE")
 
 # Parse version (format: major.minor.patch)
 if [[ ! "$current_version" =~ ^([0-9]+)\.([0-9]+)\.([0-9]+)$ ]]; then
@@ -8,97 +8,238 @@ import subprocess
 import json
 import sys
 import os
-import select
+import selectors
 import time
-import glob
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+# orjson encodes straight to UTF-8 bytes and is much faster on the large
+# didOpen payloads; stdlib json is used when it is not installed.
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+    json_loads = json.loads
+
+# Documents kept open in clangd at once while linting
+WINDOW = 16
+# Report the open files as failed if clangd publishes nothing for this long.
+# Files queue behind clangd's worker threads, so this measures a stall of
+# the whole session rather than how long any one file has been open.
+STALL_TIMEOUT = 30
+# Document version sent with didOpen; clangd echoes it in publishDiagnostics
+DOC_VERSION = 1
+
+def encode_message(payload):
+    msg = json_dumps(payload)
+    return b"Content-Length: %d\r\n\r\n%s" % (len(msg), msg)
+
+def encode_notification(method, params):
+    return encode_message({"jsonrpc": "2.0", "method": method, "params": params})
 
 def send_request(proc, method, params, msg_id):
-    msg = json.dumps({"jsonrpc": "2.0", "id": msg_id, "method": method, "params": params})
-    content = f"Content-Length: {len(msg)}\r\n\r\n{msg}"
-    proc.stdin.write(content.encode())
+    proc.stdin.write(encode_message({"jsonrpc": "2.0", "id": msg_id, "method": method, "params": params}))
     proc.stdin.flush()
 
 def send_notification(proc, method, params):
-    msg = json.dumps({"jsonrpc": "2.0", "method": method, "params": params})
-    content = f"Content-Length: {len(msg)}\r\n\r\n{msg}"
-    proc.stdin.write(content.encode())
+    proc.stdin.write(encode_notification(method, params))
     proc.stdin.flush()
 
-def read_response(proc, timeout=0.1):
-    if not select.select([proc.stdout], [], [], timeout)[0]:
-        return None
-    headers = {}
-    while True:
-        line = proc.stdout.readline().decode().strip()
-        if not line:
-            break
-        if ": " in line:
-            key, value = line.split(": ", 1)
-            headers[key] = value
-    length = int(headers.get("Content-Length", 0))
-    if length:
-        body = proc.stdout.read(length).decode()
-        return json.loads(body)
-    return None
-
-def lint_file(filepath, root_dir):
-    """Lint a single file using clangd."""
+class LspReader:
+    """Incremental LSP message parser over a non-blocking pipe.
+
+    Each read pulls everything the pipe has buffered, so one syscall can
+    yield several messages; partial messages stay in buf until complete.
+    """
+
+    def __init__(self, fd):
+        os.set_blocking(fd, False)
+        self.fd = fd
+        self.buf = bytearray()
+        self.eof = False
+
+    def feed_and_parse(self):
+        """Read available data and return all complete messages."""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            data = None
+        if data == b"":
+            self.eof = True
+        elif data:
+            self.buf += data
+
+        messages = []
+        while True:
+            header_end = self.buf.find(b"\r\n\r\n")
+            if header_end < 0:
+                break
+            length = 0
+            for line in bytes(self.buf[:header_end]).split(b"\r\n"):
+                key, _, value = line.partition(b":")
+                if key.strip().lower() == b"content-length":
+                    length = int(value)
+            body_start = header_end + 4
+            if len(self.buf) < body_start + length:
+                break
+            messages.append(json_loads(self.buf[body_start:body_start + length]))
+            del self.buf[:body_start + length]
+        return messages
 
+def find_sources(directory, suffixes=(".cpp",)):
+    """Recursively yield source files under directory using os.scandir.
+
+    Hidden entries are skipped, matching glob's treatment of dot names.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from find_sources(entry.path, suffixes)
+            elif entry.is_file(follow_symlinks=False) and entry.name.endswith(suffixes):
+                yield entry.path
+
+def start_clangd(root_dir):
+    """Start a clangd session and complete the initialize handshake.
+
+    Returns the process, its LspReader and the session selector, or
+    (None, None, None) on failure.
+    """
+
+    # stderr is discarded: clangd logs continuously and an undrained pipe
+    # would eventually block a long-lived session. Pipes are unbuffered;
+    # all reads go through LspReader on the raw descriptor.
     proc = subprocess.Popen(
         ["clangd", "--enable-config", "--clang-tidy"],
+        bufsize=0,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
         cwd=root_dir
     )
 
-    diagnostics = []
-    abs_path = os.path.abspath(os.path.join(root_dir, filepath))
-
-    # Initialize
     send_request(proc, "initialize", {
         "processId": os.getpid(),
-        "rootUri": f"file://{root_dir}",
-        "capabilities": {}
+        "rootUri": Path(root_dir).as_uri(),
+        "capabilities": {
+            "textDocument": {"publishDiagnostics": {"versionSupport": True}}
+        }
     }, 1)
 
+    # One selector (epoll/kqueue where available) serves the whole session,
+    # so stdout is registered once rather than rebuilt on every poll.
+    reader = LspReader(proc.stdout.fileno())
+    sel = selectors.DefaultSelector()
+    sel.register(proc.stdout, selectors.EVENT_READ)
+
     start = time.time()
-    initialized = False
-    file_opened = False
+    while time.time() - start < 5 and not reader.eof:
+        if not sel.select(timeout=0.1):
+            continue
+        for resp in reader.feed_and_parse():
+            if resp.get("id") == 1 and "result" in resp:
+                send_notification(proc, "initialized", {})
+                return proc, reader, sel
 
-    while time.time() - start < 5:
-        resp = read_response(proc, 0.1)
+    stop_clangd(proc, sel)
+    return None, None, None
 
-        if resp:
-            if resp.get("method") == "textDocument/publishDiagnostics":
-                diagnostics.extend(resp.get("params", {}).get("diagnostics", []))
-            elif "result" in resp and not initialized:
-                initialized = True
-                send_notification(proc, "initialized", {})
+def stop_clangd(proc, sel):
+    sel.close()
+    proc.terminate()
+    proc.wait()
+
+def lint_files(proc, reader, sel, files, root_dir):
+    """Lint files through one clangd session, keeping up to WINDOW open at once.
+
+    Returns a dict mapping each file path to its diagnostics, and the list
+    of file paths clangd never published diagnostics for.
+    """
+
+    # Documents are keyed by absolute path: clangd percent-encodes the URIs
+    # it publishes, and src/a.cpp and ./src/a.cpp must share one document.
+    paths = {}  # abs path -> file paths as given
+    for filepath in files:
+        abs_path = os.path.abspath(os.path.join(root_dir, filepath))
+        paths.setdefault(abs_path, []).append(filepath)
+
+    results = {}
+    timed_out = []
+    in_flight = set()  # abs paths with an open document
+    queue = list(reversed(paths))
+    outbox = bytearray()
+
+    # Writes are non-blocking so a large didOpen never stalls reading
+    stdin_fd = proc.stdin.fileno()
+    os.set_blocking(stdin_fd, False)
+    writing = False
 
-        if initialized and not file_opened:
-            file_opened = True
+    def finish(abs_path, diagnostics):
+        in_flight.remove(abs_path)
+        for filepath in paths[abs_path]:
+            if diagnostics is None:
+                timed_out.append(filepath)
+            else:
+                results[filepath] = diagnostics
+        # Release the AST; clangd keeps every open document in memory
+        outbox.extend(encode_notification("textDocument/didClose", {
+            "textDocument": {"uri": Path(abs_path).as_uri()}
+        }))
+
+    last_publish = time.time()
+    while queue or in_flight:
+        while queue and len(in_flight) < WINDOW:
+            abs_path = queue.pop()
             with open(abs_path) as f:
                 text = f.read()
-            send_notification(proc, "textDocument/didOpen", {
+            outbox += encode_notification("textDocument/didOpen", {
                 "textDocument": {
-                    "uri": f"file://{abs_path}",
+                    "uri": Path(abs_path).as_uri(),
                     "languageId": "cpp",
-                    "version": 1,
+                    "version": DOC_VERSION,
                     "text": text
                 }
             })
+            in_flight.add(abs_path)
 
-        if file_opened and diagnostics:
-            time.sleep(0.2)
-            while (resp := read_response(proc, 0.1)):
-                if resp.get("method") == "textDocument/publishDiagnostics":
-                    diagnostics.extend(resp.get("params", {}).get("diagnostics", []))
-            break
+        if bool(outbox) != writing:
+            writing = bool(outbox)
+            if writing:
+                sel.register(proc.stdin, selectors.EVENT_WRITE)
+            else:
+                sel.unregister(proc.stdin)
 
-    proc.terminate()
-    proc.wait()
-    return diagnostics
+        for key, _ in sel.select(timeout=1.0):
+            if key.fileobj is proc.stdin:
+                try:
+                    del outbox[:os.write(stdin_fd, outbox)]
+                except BrokenPipeError:
+                    raise RuntimeError("clangd exited before all files were linted")
+                continue
+            for resp in reader.feed_and_parse():
+                if resp.get("method") != "textDocument/publishDiagnostics":
+                    continue
+                last_publish = time.time()
+                # clangd publishes once per document version, after the AST
+                # (including clang-tidy checks) is built, even when clean
+                params = resp.get("params", {})
+                abs_path = unquote(urlparse(params.get("uri", "")).path)
+                if abs_path in in_flight and params.get("version", DOC_VERSION) == DOC_VERSION:
+                    finish(abs_path, params.get("diagnostics", []))
+            if reader.eof:
+                raise RuntimeError("clangd exited before all files were linted")
+
+        if in_flight and time.time() - last_publish >= STALL_TIMEOUT:
+            for abs_path in list(in_flight):
+                finish(abs_path, None)
+            last_publish = time.time()
+
+    if writing:
+        sel.unregister(proc.stdin)
+    os.set_blocking(stdin_fd, True)
+    return results, timed_out
 
 def main():
     root_dir = os.getcwd()
@@ -106,8 +247,10 @@ def main():
     # Get files from command line or find all
     if len(sys.argv) > 1:
         files = sys.argv[1:]
+    elif os.path.isdir("src"):
+        files = sorted(find_sources("src"))
     else:
-        files = glob.glob("src/**/*.cpp", recursive=True)
+        files = []
 
     if not files:
         print("No files to check")
@@ -115,10 +258,24 @@ def main():
 
     print(f"Checking {len(files)} file(s) with clangd...")
 
+    proc, reader, sel = start_clangd(root_dir)
+    if proc is None:
+        print("Error: clangd did not respond to initialize")
+        return 1
+
+    try:
+        results, timed_out = lint_files(proc, reader, sel, files, root_dir)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return 1
+    finally:
+        stop_clangd(proc, sel)
+
     total_warnings = 0
     for filepath in files:
-        diags = lint_file(filepath, root_dir)
-        for d in diags:
+        if filepath not in results:
+            continue
+        for d in results[filepath]:
             if d.get("severity", 1) <= 2:  # Error or Warning
                 line = d.get("range", {}).get("start", {}).get("line", 0) + 1
                 col = d.get("range", {}).get("start", {}).get("character", 0) + 1
@@ -127,11 +284,14 @@ def main():
                 print(f"{filepath}:{line}:{col}: warning: {msg} [{code}]")
                 total_warnings += 1
 
+    for filepath in timed_out:
+        print(f"{filepath}: error: no diagnostics from clangd (timed out)")
+
     print(f"\n{'='*40}")
     print(f"clangd lint: {total_warnings} warning(s)")
     print(f"{'='*40}")
 
-    return 0 if total_warnings == 0 else 1
+    return 0 if total_warnings == 0 and not timed_out else 1
 
 if __name__ == "__main__":
     sys.exit(main())